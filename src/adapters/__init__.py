@@ -0,0 +1 @@
+from .plan_cache import PlanCache
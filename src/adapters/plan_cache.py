@@ -0,0 +1,101 @@
+from pathlib import Path
+from contextlib import closing
+from typing import Callable
+import sqlite3
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class PlanCache:
+    """
+    Semantic cache of successful plans, keyed by the embedding of the user query.
+
+    Attributes:
+        db_path (Path): Path of the SQLite database storing the cached plans.
+        threshold (float): Minimum cosine similarity for a cached plan to be reused.
+        model_name (str): Name of the sentence-transformers model used as embedder.
+    """
+
+    def __init__(
+        self,
+        db_path: str = "output/.plan_cache.db",
+        threshold: float = 0.90,
+        model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+        embedder: Callable[[str], np.ndarray] | None = None
+    ):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.threshold = threshold
+        self.model_name = model_name
+        self._embedder = embedder     # Custom embedder, otherwise the local model is loaded on first use
+
+        with closing(sqlite3.connect(self.db_path)) as conn, conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS plans (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    goal_embedding BLOB NOT NULL,
+                    code_template TEXT NOT NULL,
+                    system_state_summary TEXT
+                )"""
+            )
+
+    def embed(self, text: str) -> np.ndarray:
+        """Embed the given text as a unit-norm float32 vector.
+
+        Args:
+            text (str): The text to embed.
+
+        Returns:
+            np.ndarray: The normalized embedding.
+        """
+        if self._embedder is None:
+            # Deferred import: the model is only loaded when the cache is actually used
+            from sentence_transformers import SentenceTransformer
+            model = SentenceTransformer(self.model_name)
+            self._embedder = model.encode
+
+        embedding = np.asarray(self._embedder(text), dtype=np.float32)
+        return embedding / (np.linalg.norm(embedding) or 1.0)
+
+    def lookup(self, embedding: np.ndarray) -> str | None:
+        """Find the code template of the most similar cached plan.
+
+        Args:
+            embedding (np.ndarray): Normalized embedding of the user query.
+
+        Returns:
+            str | None: The cached code template, or None if no plan is similar enough.
+        """
+        with closing(sqlite3.connect(self.db_path)) as conn:
+            rows = conn.execute("SELECT goal_embedding, code_template FROM plans").fetchall()
+
+        if not rows:
+            return None
+
+        embeddings = np.stack([np.frombuffer(row[0], dtype=np.float32) for row in rows])
+        similarities = embeddings @ embedding     # Cosine similarity, vectors are normalized
+        best = int(np.argmax(similarities))
+
+        if similarities[best] < self.threshold:
+            return None
+
+        logger.info("Plan cache hit (similarity %.3f)", similarities[best])
+        return rows[best][1]
+
+    def store(self, embedding: np.ndarray, code_template: str, system_state_summary: str = "") -> None:
+        """Store a successful plan, unless the same code is already stored.
+
+        Args:
+            embedding (np.ndarray): Normalized embedding of the user query.
+            code_template (str): The code that completed the task.
+            system_state_summary (str): Short description of the state the plan ended in.
+        """
+        with closing(sqlite3.connect(self.db_path)) as conn, conn:
+            # Duplicates would only grow the table, which `lookup` loads entirely
+            conn.execute(
+                """INSERT INTO plans (goal_embedding, code_template, system_state_summary)
+                SELECT ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM plans WHERE code_template = ?)""",
+                (embedding.astype(np.float32).tobytes(), code_template, system_state_summary, code_template)
+            )
@@ -1,15 +1,110 @@
 from typing import Literal
 from langgraph.graph import StateGraph, END
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from langgraph.graph.state import CompiledStateGraph
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolCall, ToolMessage, message_chunk_to_message
 from langchain_google_genai import ChatGoogleGenerativeAI
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+import asyncio
+import hashlib
+import json
 import logging
 import os
+import re
 
 from src.agent.state import AgentState
-from src.tools.code_executor import execute_python_code
+from src.adapters.plan_cache import PlanCache
+from src.tools.code_executor import ENABLE_NUMBA, execute_python_code, get_sandbox, run_python_code
 
 logger = logging.getLogger(__name__)
 
+_BOUND_LLM_CACHE: dict[tuple, Runnable] = {}     # Tool-bound models, by (model, temperature, API key, tool names)
+
+# Patterns compiled once
+_CODE_RE = re.compile(r"```(?:python)?\s*\n?(.*?)```", re.DOTALL)     # Markdown code block
+_TASK_COMPLETE_RE = re.compile(r"TASK_COMPLETE", re.IGNORECASE)       # Completion sentinel, no upper-cased copy of the response
+
+# Static prompts, kept byte-identical across calls so that the provider can cache the prompt prefix.
+# Guided system prompt to explicitly instruct the agent activities
+SYSTEM_PROMPT = """You are a data analysis and visualization expert using the ReAct framework.
+
+Your task is to help users with data analysis and create Plotly visualizations.
+
+**ReAct Process:**
+1. **Thought**: Reason about what needs to be done
+2. **Action**: Call the `execute_python` tool with the Python code to execute
+3. **Observation**: Review the execution result
+
+**Important:**
+- Break complex tasks into steps if needed
+- If execution fails, analyze the error and adjust your approach
+
+When you have completed the task successfully, respond with "TASK_COMPLETE" without calling any tool."""
+
+# Guided tool prompt to explicitly instruct the agent to code generation
+TOOL_PROMPT = """**Available Tools:**
+- execute_python: Execute Python code for data analysis and visualization. The code should save plots at the path given by the `SANDBOX_PLOT_PATH` environment variable.
+  Returns a JSON object: `ok` (whether the code succeeded), `out` (its printed output, truncated), `err` (the end of its error output) and `plot` (path of the saved plot, or null).
+
+**Code Requirements:**
+- Include all necessary imports (pandas, plotly, numpy, etc.)
+- Always save Plotly figures using: fig.write_html(os.environ.get('SANDBOX_PLOT_PATH', 'output.html')), with `import os`
+- Include error handling where appropriate
+- Add comments to explain key steps"""
+
+if ENABLE_NUMBA:
+    TOOL_PROMPT += """
+- For row-wise numeric transforms, define a helper decorated with `@njit` (already imported, together with `prange`) and call it"""
+
+def _summarize_step(message: BaseMessage) -> str:
+    """One-line digest of a past message, used in the summary of the older steps."""
+    content = message.text.strip()
+    if isinstance(message, (ToolMessage, HumanMessage)):
+        return f"- Observation: {content[:300]}"
+    line = f"- Thought: {content[:300]}" if content else "- Thought: (none)"
+    for tool_call in getattr(message, "tool_calls", []):
+        line += f"\n- Action: executed {len(tool_call['args'].get('code', '').splitlines())} lines of code"
+    return line
+
+def _compact(messages: list[BaseMessage], keep_recent: int) -> list[BaseMessage]:
+    """
+    Bound the history sent to the LLM: the messages up to the user query and the last
+    `keep_recent` messages are kept verbatim, older ones are deduplicated and replaced by
+    a single summary. Messages kept verbatim are never dropped, to preserve the turn order.
+
+    Args:
+        messages (list[BaseMessage]): Conversation history.
+        keep_recent (int): Number of recent messages to keep verbatim.
+
+    Returns:
+        list[BaseMessage]: The compacted history.
+    """
+    # Head: everything up to the original user query (plan cache seed included)
+    head_end = next((i + 1 for i, msg in enumerate(messages) if isinstance(msg, HumanMessage)), 0)
+    split = len(messages) - keep_recent
+    # Never separate tool results from the AI message that requested them
+    while split > head_end and isinstance(messages[split], ToolMessage):
+        split -= 1
+    if split <= head_end:
+        return messages
+
+    # Repeated messages (e.g. the same error observed twice) are summarized once
+    older, seen = [], set()
+    for msg in messages[head_end:split]:
+        content = msg.text
+        digest = hashlib.sha1(f"{msg.type}:{content[:4096]}".encode()).digest() if content else id(msg)
+        if id(msg) in seen or digest in seen:
+            continue
+        seen.update((id(msg), digest))
+        older.append(msg)
+
+    # Rebuilt at each call: the summarized slice grows by one step per iteration, a memo would never hit
+    summary = "Prior steps summary:\n" + "\n".join(_summarize_step(msg) for msg in older)
+
+    # The summary is a user turn: Gemini requires a function call to follow a user or function response turn
+    return messages[:head_end] + [HumanMessage(content=summary)] + messages[split:]
+
 class DataAnalysisAgent:
     """
     ReAct-style agent for data analysis and visualization.
@@ -17,148 +112,132 @@ class DataAnalysisAgent:
     Attributes:
         llm: The language model used for reasoning and code generation.
         max_iterations (int): Maximum number of ReAct iterations to perform.
-        graph: The state graph defining the ReAct workflow.
+        plan_cache (PlanCache | None): Optional cache of successful plans, reused for similar queries.
     """
 
-    def __init__(self, model_name: str = "gemini-2.5-flash", max_iterations: int = 5):
+    _graphs: dict[int, CompiledStateGraph] = {}     # Compiled graphs, by iteration cap
+
+    def __init__(self, model_name: str = "gemini-2.5-flash", max_iterations: int = 5, plan_cache: PlanCache | None = None):
         # Get API key from environment variable
         api_key = os.getenv("GOOGLE_API_KEY")
 
-        self.llm = ChatGoogleGenerativeAI(
-            model=model_name, 
-            temperature=0,
-            google_api_key=api_key
-        )
+        # Bind the code execution tool so reasoning and action come back in a single response.
+        # The bound model is immutable, so it is shared by the agents with the same configuration
+        # instead of rebuilding the client and the tool schema for each one
+        tools = [execute_python_code]
+        key = (model_name, 0, api_key, tuple(sorted(t.name for t in tools)))
+        if key not in _BOUND_LLM_CACHE:
+            _BOUND_LLM_CACHE[key] = ChatGoogleGenerativeAI(
+                model=model_name, 
+                temperature=0,
+                google_api_key=api_key
+            ).bind_tools(tools, tool_choice="auto")
+        self.llm = _BOUND_LLM_CACHE[key]
         self.max_iterations = max_iterations
-        self.graph = self._build_graph()
+        self.plan_cache = plan_cache
+        self._prompt_prefix = [SystemMessage(content=SYSTEM_PROMPT), SystemMessage(content=TOOL_PROMPT)]  # Invariant prefix of every LLM call
+        self._graph = self._build_graph(max_iterations)     # Shared compiled graph, driven through `arun`/`run` which pass the agent in the config
+        get_sandbox()   # The execution kernel warms up while the first response is generated
+
+    @classmethod
+    def _build_graph(cls, max_iterations: int):
+        """
+        Build the ReAct graph specialized for the given iteration cap, compiled once and
+        shared by all the agents with the same cap. The nodes run on the agent passed in
+        the `configurable` of the run config, so the graph holds no agent state.
+        """
+        if max_iterations in cls._graphs:
+            return cls._graphs[max_iterations]
+
+        async def reason_act(state: AgentState, config: RunnableConfig) -> AgentState:
+            return await config["configurable"]["agent"]._reason_act_node(state)
+
+        def observe(state: AgentState, config: RunnableConfig) -> AgentState:
+            return config["configurable"]["agent"]._observe_node(state)
+
+        def should_continue(state: AgentState) -> Literal["continue", "end"]:
+            # Iteration cap closed over as a local constant, no lookups on the hot path
+            if state["task_complete"]:
+                return "end"
+            if state["iteration"] >= max_iterations:
+                logger.warning("Max iterations (%d) reached", max_iterations)
+                return "end"
+            return "continue"
 
-    def _build_graph(self):
         workflow = StateGraph(AgentState)
         
-        workflow.add_node("plan", self._plan_node)          # Planning node
-        workflow.add_node("act", self._act_node)            # Action node
-        workflow.add_node("observe", self._observe_node)    # Observation node
+        workflow.add_node("plan_act", reason_act)   # Reasoning + action node (single LLM call)
+        workflow.add_node("observe", observe)       # Observation node
         
-        workflow.set_entry_point("plan")    # Starting point of the workflow
+        workflow.set_entry_point("plan_act")    # Starting point of the workflow
         
-        workflow.add_edge("plan", "act")        # Plan -> Act
-        workflow.add_edge("act", "observe")     # Act -> Observe
-        workflow.add_conditional_edges(         # Iteration control
-            "observe",
-            self._should_continue,              # Observe -> (Plan | END)
+        workflow.add_conditional_edges(             # Skip the observation once the task is complete
+            "plan_act",
+            lambda state: "end" if state["task_complete"] else "observe",   # Plan/Act -> (Observe | END)
             {
-                "continue": "plan",
+                "observe": "observe",
                 "end": END
             }
         )
+        if max_iterations == 1:     # A single iteration always ends after the observation
+            workflow.add_edge("observe", END)
+        else:
+            workflow.add_conditional_edges(         # Iteration control
+                "observe",
+                should_continue,                    # Observe -> (Plan/Act | END)
+                {
+                    "continue": "plan_act",
+                    "end": END
+                }
+            )
         
-        return workflow.compile()
+        cls._graphs[max_iterations] = workflow.compile()
+        return cls._graphs[max_iterations]
     
-    def _plan_node(self, state: AgentState) -> AgentState:
+    async def _reason_act_node(self, state: AgentState) -> AgentState:
         """
-        Planning phase
+        Reasoning and action phase in a single LLM round-trip: the model returns its
+        reasoning in `content` and the code to run in `tool_calls`.
 
         Args:
             state (AgentState): Current state of the agent.
 
         Returns:
-            AgentState: Updated state after planning.
+            AgentState: Updated state after reasoning and action.
         """
-        logger.info(f"Planning (iteration {state['iteration']})")
+        logger.info("Planning and acting (iteration %d)", state["iteration"])
         
-        # Guided system prompt to explicitly instruct the agent activities
-        system_prompt = """
-        You are a data analysis and visualization expert using the ReAct framework.
-
-        Your task is to help users with data analysis and create Plotly visualizations.
-
-        **Available Tools:**
-        - execute_python: Execute Python code for data analysis and visualization. The code should save plots as 'output.html' in the current directory.
-
-        **ReAct Process:**
-        1. **Thought**: Reason about what needs to be done
-        2. **Action**: Decide to execute Python code
-        3. **Observation**: Review the execution result
-
-        **Important:**
-        - Always save Plotly figures as 'output.html' using: fig.write_html('output.html')
-        - Import required libraries (pandas, plotly, numpy, etc.)
-        - Break complex tasks into steps if needed
-        - If execution fails, analyze the error and adjust your approach
-
-        When you have completed the task successfully, respond with "TASK_COMPLETE"."""
-
-        messages = [SystemMessage(content=system_prompt)] + state["messages"]   # Inject system prompt before the conversation history
+        history = _compact(state["messages"], keep_recent=4)   # Bound the prompt size on long runs
+        messages = self._prompt_prefix + history   # Inject the static prompts before the conversation history
         
-        response = self.llm.invoke(messages)
-        logger.info(f"Plan: {response.content[:200]}...")
+        # Stream the response, to stop the generation as soon as the model declares the task complete
+        response, text = None, ""  # `text` accumulates the text of the chunks, whose content may be a list of blocks
+        async with aclosing(self.llm.astream(messages)) as stream:   # Closing the stream on break stops the generation
+            async for chunk in stream:
+                response = chunk if response is None else response + chunk
+                delta = chunk.text
+                text += delta
+                # Only the new tail is searched, the sentinel may span two chunks
+                if not response.tool_call_chunks and _TASK_COMPLETE_RE.search(text, max(0, len(text) - len(delta) - len("TASK_COMPLETE"))):
+                    logger.info("Task completion detected, stopping the generation")
+                    break
+        response = message_chunk_to_message(response) if response is not None else AIMessage(content="")
+        if logger.isEnabledFor(logging.INFO):   # Avoid slicing the response when INFO is disabled
+            logger.info("Plan: %s...", response.text[:200])
         
-        return {
-            "messages": [AIMessage(content=f"**Thought: (Iteration {state['iteration']}):** {response.content}")],   # Create a new message with AI's thought
-            "iteration": state["iteration"],
-            "max_iterations": state["max_iterations"],
-            "task_complete": "TASK_COMPLETE" in response.content.upper()    # Mark task as complete if indicated
-        }
-    
-    def _act_node(self, state: AgentState) -> AgentState:
-        """
-        Action phase: Generate and prepare to execute code.
-        
-        Args:
-            state (AgentState): Current state of the agent.
-
-        Returns:
-            AgentState: Updated state after action.
-        """
-        logger.info("Acting - generating code")
+        # The code to execute comes from the tool calls of the response
+        pending_calls = response.tool_calls
+        if not pending_calls:
+            code = self._extract_code(response.text)    # Fallback: code written inline instead of calling the tool
+            if code:
+                pending_calls = [ToolCall(name=execute_python_code.name, args={"code": code}, id=None)]
         
-        # Check if task is already complete before generating code
-        if state["task_complete"]:
-            return {
-                "messages": [],    
-                "iteration": state["iteration"],
-                "max_iterations": state["max_iterations"],
-                "task_complete": True
-            }
-        
-        # Guided system prompt to explicitly instruct the agent to code generation
-        code_prompt = """
-        Based on your thought process, generate the Python code to execute.
-
-        **Requirements:**
-        - Include all necessary imports
-        - Save Plotly figures as 'output.html' using: fig.write_html('output_<time_stamp>.html')
-        - Include error handling where appropriate
-        - Add comments to explain key steps
-
-        Respond with ONLY the Python code, wrapped in ```python <code blocks>```."""
-
-        messages = state["messages"] + [HumanMessage(content=code_prompt)]  # Append code generation prompt to conversation history
-        response = self.llm.invoke(messages)
-        
-        # Extract code from response
-        code = self._extract_code(response.content)
-        
-        if not code:    # No code generated
-            logger.warning("No code generated")
-            return {
-                "messages": [AIMessage(content="**Action: No code to execute. Need to rethink approach.**")],   # Explicitly state no code was generated and force rethink a new plan
-                "iteration": state["iteration"],
-                "max_iterations": state["max_iterations"],
-                "task_complete": False
-            }
-        
-        logger.info(f"Generated code:\n{code[:200]}...")
-        
-        # Otherwise, return the code to be executed
         return {
-            "messages": [
-                AIMessage(content=f"**Action: Executing Python code:\n```python\n{code}\n```**"),
-                HumanMessage(content=f"CODE_TO_EXECUTE:{code}")
-            ],  # Prepare message with code to execute
+            "messages": [response],     # Keep the AI message as is, tool calls included
             "iteration": state["iteration"],
             "max_iterations": state["max_iterations"],
-            "task_complete": False
+            "task_complete": not response.tool_calls and _TASK_COMPLETE_RE.search(response.text) is not None,   # Mark task as complete if indicated
+            "pending_calls": pending_calls
         }
     
     def _observe_node(self, state: AgentState) -> AgentState:
@@ -173,99 +252,91 @@ class DataAnalysisAgent:
         """
         logger.info("Observing - executing code")
         
-        # Check if task is already complete
-        if state["task_complete"]:
+        pending_calls = state["pending_calls"]
+        
+        if not pending_calls:
             return {
-                "messages": [],
+                "messages": [HumanMessage(content="**Observation: No code found to execute. Call the `execute_python` tool with the code to run.**")],
                 "iteration": state["iteration"] + 1,
                 "max_iterations": state["max_iterations"],
-                "task_complete": True
+                "task_complete": False
             }
         
-        # Find the code to execute from the last message
-        code = None
-        for msg in reversed(state["messages"]):
-            if hasattr(msg, 'content') and "CODE_TO_EXECUTE:" in msg.content:
-                code = msg.content.split("CODE_TO_EXECUTE:", 1)[1].strip()  # Retrieved code part
-                break
-        
-        if not code:
-            observation = "No code found to execute."
+        # The code is run directly, the tool call arguments need no further validation
+        codes = [str(tool_call["args"].get("code", "")) for tool_call in pending_calls]
+        if len(codes) == 1:
+            observations = [run_python_code(codes[0])]
         else:
-            # Execute the code
-            observation = execute_python_code.invoke({"code": code})
-
-            # If execution was successful AND plot was generated, task marked as complete
-            task_complete = (
-                "Code executed successfully" in observation 
-                and "Generated plot available at:" in observation
-            )
-
-            if task_complete:
-                logger.info("Task automatically marked complete after successful execution")
+            # Independent tool calls are executed concurrently, results are kept in the original order
+            logger.info("Executing %d tool calls concurrently", len(codes))
+            with ThreadPoolExecutor(max_workers=len(codes)) as executor:
+                observations = list(executor.map(run_python_code, codes))
+        
+        messages = []
+        current_code, plot_path = codes[-1], None
+        for tool_call, code, observation in zip(pending_calls, codes, observations):
+            if tool_call["id"]:     # Answer the tool call with its result
+                messages.append(ToolMessage(content=observation, tool_call_id=tool_call["id"], name=tool_call["name"]))
+            else:
+                messages.append(HumanMessage(content=f"**Observation: {observation}**"))
+            
+            if plot_path is None:
+                result = json.loads(observation)
+                # If execution was successful AND plot was generated, task marked as complete
+                if result["ok"] and result["plot"]:
+                    current_code = code
+                    plot_path = result["plot"]
+                    logger.info("Task automatically marked complete after successful execution")
         
         return {
-            "messages": [AIMessage(content=f"**Observation: {observation}**")],
+            "messages": messages,
             "iteration": state["iteration"] + 1,
             "max_iterations": state["max_iterations"],
-            "task_complete": task_complete
+            "task_complete": plot_path is not None,
+            "current_code": current_code,
+            "execution_output": "\n\n".join(observations),
+            "plot_path": plot_path
         }
     
-    def _should_continue(self, state: AgentState) -> Literal["continue", "end"]:
-        """
-        Decide whether to continue the ReAct loop or end.
-        
-        Args:
-            state (AgentState): Current state of the agent.
-        Returns:
-            Literal["continue", "end"]: Decision to continue or end the loop.
-        """
-        
-        # Check if task is complete
-        if state["task_complete"]:
-            logger.info("Task marked as complete")
-            return "end"
-        
-        # Check max iterations
-        if state["iteration"] >= state["max_iterations"]:
-            logger.warning(f"Max iterations ({state['max_iterations']}) reached")
-            return "end"
-        
-        # Check if last observation indicates success
-        last_message = state["messages"][-1] if state["messages"] else None
-        if last_message and "Generated plot available at:" in last_message.content:     # If true -> plot saved successfully then code was genereted and executed successfully -> end the loop
-            logger.info("Plot generated successfully")
-            return "end"
-        
-        return "continue"
-    
     def _extract_code(self, content: str) -> str:
         """
-        Extract Python code from markdown code blocks.
+        Extract Python code from markdown code blocks, used when the model writes the
+        code inline instead of calling the tool.
 
         Args:
             content (str): The content containing the code.
 
         Returns:
-            str: Extracted Python code.
+            str: Extracted Python code, empty if no code block is found.
         """
-        # Case 1: Python code wrapped in ```python <code> ```
-        if "```python" in content:
-            parts = content.split("```python")
-            if len(parts) > 1:
-                code = parts[1].split("```")[0].strip()
-                return code
-        # Case 2: Code wrapped in generic ``` <code> ```
-        elif "```" in content:
-            parts = content.split("```")
-            if len(parts) > 2:
-                code = parts[1].strip()
-                return code
-        # Case 3: No code wrapped
-        return content.strip()
+        # Single pass over both ```python <code> ``` and generic ``` <code> ``` blocks
+        match = _CODE_RE.search(content)
+        return match.group(1).strip() if match else ""   # No code wrapped, plain text is reasoning only
     
     def run(self, user_query: str) -> dict:
-        """Run the ReAct agent on a user query.
+        """Run the ReAct agent on a user query. Must not be called from a running event loop, use `arun` there.
+        
+        Args:
+            user_query: The user's request for data analysis or visualization
+            
+        Returns:
+            dict: Final state containing messages and execution history
+        """
+        return asyncio.run(self.arun(user_query))
+    
+    async def arun_many(self, user_queries: list[str]) -> list[dict]:
+        """Run the ReAct agent on independent queries concurrently.
+        
+        Args:
+            user_queries: The user's requests for data analysis or visualization
+            
+        Returns:
+            list[dict]: Final states, in the same order as the queries
+        """
+        return await asyncio.gather(*(self.arun(user_query) for user_query in user_queries))
+    
+    async def arun(self, user_query: str) -> dict:
+        """Run the ReAct agent on a user query, asynchronously.
         
         Args:
             user_query: The user's request for data analysis or visualization
@@ -273,16 +344,43 @@ class DataAnalysisAgent:
         Returns:
             dict: Final state containing messages and execution history
         """
-        logger.info(f"Starting ReAct agent with query: {user_query}")
+        logger.info("Starting ReAct agent with query: %s", user_query)
         
+        messages = [HumanMessage(content=user_query)]   # Initial message from user
+
+        # Seed the agent with the plan of a similar successful query, if any
+        embedding, seeded = None, False
+        if self.plan_cache:
+            try:
+                embedding = await asyncio.to_thread(self.plan_cache.embed, user_query)    # Keep the event loop free while embedding
+                template = self.plan_cache.lookup(embedding)
+                if template:
+                    messages.insert(0, SystemMessage(content=f"Adapt this prior successful plan: ```python\n{template}\n```"))
+                    seeded = True
+            except Exception as e:  # The cache must never prevent the agent from running
+                logger.warning("Plan cache unavailable: %s", e)
+                embedding = None
+
         initial_state = {
-            "messages": [HumanMessage(content=user_query)],     # Initial message from user
+            "messages": messages,
             "iteration": 0,
             "max_iterations": self.max_iterations,
-            "task_complete": False
+            "task_complete": False,
+            "pending_calls": [],
+            "current_code": None,
+            "execution_output": None,
+            "plot_path": None
         }
         # Start the loop
-        final_state = self.graph.invoke(initial_state)
+        final_state = await self._graph.ainvoke(initial_state, config={"configurable": {"agent": self}})  # The observe node is sync, LangGraph runs it in a worker thread
         # End of the loop
+
+        # Store the successful code as template for similar queries, unless a stored plan already covers this one
+        if embedding is not None and not seeded and final_state["plot_path"]:
+            try:
+                self.plan_cache.store(embedding, final_state["current_code"], system_state_summary=final_state["execution_output"][:500])
+            except Exception as e:
+                logger.warning("Failed to store plan in cache: %s", e)
+
         logger.info("ReAct agent completed")
-        return final_state
\ No newline at end of file
+        return final_state
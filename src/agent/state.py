@@ -1,5 +1,5 @@
 from typing import TypedDict, Annotated
-from langchain_core.messages import BaseMessage
+from langchain_core.messages import BaseMessage, ToolCall
 import operator
 
 class AgentState(TypedDict):
@@ -11,8 +11,18 @@ class AgentState(TypedDict):
         iteration (int): Current iteration count of the agent's reasoning loop.
         max_iterations (int): Maximum allowed iterations for the agent.
         task_complete (bool): Flag indicating whether the task has been completed.
+        pending_calls (list[ToolCall]): Code executions requested by the last reasoning step. The `id` is None if the code was written inline.
+        current_code (str | None): Code of the last observed execution, the one that generated the plot if any.
+        execution_output (str | None): Output of the last code execution.
+        plot_path (str | None): Path of the generated plot, set once the code produced one.
     """
+    # The reducer must not mutate its arguments: LangGraph re-applies the writes on shallow copies of the
+    # channels (e.g. to evaluate conditional edges), so an in-place `extend` would duplicate messages
     messages: Annotated[list[BaseMessage], operator.add]   
     iteration: int          
     max_iterations: int     
     task_complete: bool     
+    pending_calls: list[ToolCall]
+    current_code: str | None
+    execution_output: str | None
+    plot_path: str | None
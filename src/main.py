@@ -1,10 +1,13 @@
 import logging
 import sys
 import os
+import io
 from dotenv import load_dotenv
-from pathlib import Path
+from functools import lru_cache
+from typing import TYPE_CHECKING
 
-from src.agent.react_agent import DataAnalysisAgent
+if TYPE_CHECKING:   # The agent and its dependencies are imported once the configuration is checked
+    from src.agent.react_agent import DataAnalysisAgent
 
 # Change this query to test different scenarios
 
@@ -16,6 +19,8 @@ EXAMPLE_QUERY = """
 Create a line chart showing the trend of sales data over 12 months. Use sample data: January through December with values [100, 120, 140, 130, 150, 170, 180, 190, 200, 210, 220, 240].
 """
 
+_RULE = "=" * 80      # Separator of the results in the console output
+
 load_dotenv()
 
 # Configure logging
@@ -42,6 +47,25 @@ def check_api_key():
     
     return True
 
+@lru_cache(maxsize=1)
+def get_agent(model_name: str = "gemini-2.5-flash", max_iterations: int = 5) -> "DataAnalysisAgent":
+    """Get the agent for the given configuration, created once and reused across queries."""
+    from src.agent.react_agent import DataAnalysisAgent
+    from src.adapters.plan_cache import PlanCache
+
+    return DataAnalysisAgent(model_name=model_name, max_iterations=max_iterations, plan_cache=PlanCache())
+
+def _render_turn(final_state: dict) -> str:
+    """Render the results of a run, to be written to the console at once."""
+    out = io.StringIO()
+    out.write(f"\n{_RULE}\n")
+    out.write("Example completed!\n")
+    out.write(f"Iterations: {final_state['iteration']}\n")
+    out.write(f"Task complete: {final_state['task_complete']}\n")
+    if final_state.get("plot_path"):    # Plot of this run, no need to scan the output directory
+        out.write(f"Generated plot: {final_state['plot_path']}\n")
+    return out.getvalue()
+
 def main():    
     if not check_api_key():
         return
@@ -55,7 +79,7 @@ def run_example():
 
     # Initialize the agent
     try:
-        agent = DataAnalysisAgent()
+        agent = get_agent()
         logger.info("Agent initialized successfully")
     except Exception as e:
         logger.error(f"Failed to initialize agent: {e}")
@@ -72,16 +96,8 @@ def run_example():
         
         final_state = agent.run(example_query)
         
-        print("\n" + "=" * 80)
-        print("Example completed!")
-        print(f"Iterations: {final_state['iteration']}")
-        print(f"Task complete: {final_state['task_complete']}")
-        
-        output_dir = Path("output")
-        if output_dir.exists():
-            plots = list(output_dir.glob("*.html"))
-            if plots:
-                print(f"Generated plot: {plots[-1]}")
+        sys.stdout.write(_render_turn(final_state))
+        sys.stdout.flush()
     
     except Exception as e:
         logger.error(f"Example execution failed: {e}", exc_info=True)
@@ -1,2 +1,3 @@
 from .sandbox import CodeSandbox
-from .code_executor import CodeInput, execute_python_code
\ No newline at end of file
+from .persistent_executor import PersistentExecutor, ClientTimeoutError, ExecutionCrashedError
+from .code_executor import CodeInput, CodeBatchInput, execute_python_code, execute_python_code_batch, get_sandbox, run_python_code
@@ -1,30 +1,38 @@
-from langchain_core.tools import tool
+from langchain_core.tools import tool, StructuredTool
 from pydantic import BaseModel, Field
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import asyncio
 import logging
+import json
 
-from .sandbox import CodeSandbox
+from .sandbox import CodeSandbox, ENABLE_NUMBA   # ENABLE_NUMBA is re-exported for the prompt of the agent
 
 logger = logging.getLogger(__name__)
-sandbox = CodeSandbox()     # Initialize the sandbox environment here to avoid overhead
+
+@lru_cache(maxsize=1)
+def get_sandbox() -> CodeSandbox:
+    """Sandbox shared by the tools, created on first use so that importing the tools starts no kernel."""
+    return CodeSandbox()
+
+MAX_STDOUT = 4000   # Characters of output returned to the model
+MAX_STDERR = 2000   # Characters of error returned to the model
 
 # Input schema for the code execution tool
 class CodeInput(BaseModel):
     code: str = Field(description="Python code to execute for data analysis and visualization.")
 
-@tool("execute_python", args_schema=CodeInput)
-def execute_python_code(code: str) -> str:
-    """Execute the provided Python code in a sandboxed environment.
+class CodeBatchInput(BaseModel):
+    codes: list[str] = Field(description="Independent Python code snippets to execute concurrently.")
 
-    Args:
-        code (str): The Python code to execute.
-
-    Returns:
-        str: The output of the code execution or error message.    
-    """
+def _prepare(code: str) -> str:
+    """Log the code before execution."""
+    if logger.isEnabledFor(logging.INFO):   # Avoid copying the code when INFO is disabled
+        logger.info("Executing code:\n%s...", code[:200])
+    return code
 
-    logger.info(f"Executing code:\n{code[:200]}...")
-    # Execute the code in the sandboxed environment
-    result = sandbox.execute_code(code)
+def _result_payload(result: dict) -> dict:
+    """Reduce the result of an execution to the tool output fields."""
 
     # See README.md for explanation about this snippet
     # if result["success"]:
@@ -36,11 +44,71 @@ def execute_python_code(code: str) -> str:
     #     logger.error(f"Code execution failed with error:\n{result['stderr']}")
     #     return 0
 
-    # Process the result and return appropriate message
-    if result["success"]:   # Code executed successfully
-        output = f"Code executed successfully.\n{result['stdout']}"
-        if result["plot_path"]:     # Plot saved successfully
-            output += f"\nGenerated plot available at: {result['plot_path']}"
-        return output
-    else:   # Execution failed
-        return f"Code execution failed with error:\n{result['stderr']}"
\ No newline at end of file
+    # Only the fields the model uses, truncated to bound the context: the head of the
+    # output and the tail of the error, where the traceback ends with the exception
+    return {
+        "ok": result["success"],
+        "out": result["stdout"][:MAX_STDOUT],
+        "err": result["stderr"][-MAX_STDERR:],
+        "plot": result["plot_path"]
+    }
+
+def _format_result(result: dict) -> str:
+    """Format the result of an execution as the tool output, a compact JSON object."""
+    return json.dumps(_result_payload(result), separators=(",", ":"))
+
+def run_python_code(code: str) -> str:
+    """Execute the code as the `execute_python` tool does, without the tool input validation.
+
+    Used by the agent, which already has the code as a string from the model tool call.
+
+    Args:
+        code (str): The Python code to execute.
+
+    Returns:
+        str: The result as JSON: `ok` (bool), `out` (stdout), `err` (stderr) and `plot` (plot path or null).
+    """
+
+    # Execute the code in the sandboxed environment
+    result = get_sandbox().execute_code(_prepare(code))
+    return _format_result(result)
+
+@tool("execute_python", args_schema=CodeInput)  # The schema describes the argument to the model
+def execute_python_code(code: str) -> str:
+    """Execute the provided Python code in a sandboxed environment.
+
+    Args:
+        code (str): The Python code to execute.
+
+    Returns:
+        str: The result as JSON: `ok` (bool), `out` (stdout), `err` (stderr) and `plot` (plot path or null).
+    """
+    return run_python_code(code)
+
+def _run_batch(codes: list[str]) -> str:
+    """Execute the code snippets concurrently, returning their results in input order as a JSON list."""
+    sandbox = get_sandbox()
+    with ThreadPoolExecutor(max_workers=max(1, min(len(codes), sandbox.concurrency_limit))) as executor:
+        results = list(executor.map(lambda code: sandbox.execute_code(_prepare(code)), codes))
+    return json.dumps([_result_payload(result) for result in results], separators=(",", ":"))
+
+async def _arun_batch(codes: list[str]) -> str:
+    """Asynchronous version of `_run_batch`."""
+    sandbox = get_sandbox()
+    semaphore = asyncio.Semaphore(sandbox.concurrency_limit)    # Executions running in the kernel at once
+
+    async def run(code: str) -> dict:
+        async with semaphore:
+            return await sandbox.execute_code_async(_prepare(code))
+
+    results = await asyncio.gather(*(run(code) for code in codes))
+    return json.dumps([_result_payload(result) for result in results], separators=(",", ":"))
+
+execute_python_code_batch = StructuredTool.from_function(
+    func=_run_batch,
+    coroutine=_arun_batch,
+    name="execute_python_batch",
+    description="Execute several independent Python code snippets concurrently in a sandboxed environment. "
+                "Returns the result of each snippet, in input order, as a JSON list of {ok, out, err, plot} objects.",
+    args_schema=CodeBatchInput
+)
@@ -0,0 +1,250 @@
+"""
+Persistent execution kernel, started once by `PersistentExecutor`.
+
+The heavy libraries are imported at startup, then each request received on stdin as a
+JSON line (`{"id": ..., "code": ..., "bytecode": ..., "cwd": ..., "env": ..., "timeout": ..., "memory_limit": ...}`,
+the optional `bytecode` being the base64 of the marshalled code object, and the optional `env`
+the variables added to the environment of the execution) is executed in
+a fresh namespace, and the result (`{"id": ..., "success": ..., "stdout": ..., "stderr": ...}`,
+`{"id": ..., "timed_out": true}`, or `{"id": ..., "crashed": true}` if the execution died without
+a result) is written back as a JSON line.
+On POSIX the kernel is a template process: each execution runs in a child forked on
+demand, which inherits the preloaded libraries copy-on-write and is bounded by CPU, memory
+and wall-clock limits. Executions run concurrently and the results are written back as
+they complete, the kernel itself is never affected by the executed code.
+The captured output is capped to its first and last characters, whatever the code prints.
+The module is standalone (no `src` imports), so that it can run as a plain script.
+"""
+from contextlib import redirect_stdout, redirect_stderr
+import traceback
+import linecache
+import select
+import time
+import marshal
+import base64
+import signal
+import json
+import sys
+import io
+import os
+
+PRELOAD = ["pandas", "numpy", "plotly.express", "plotly.graph_objects"]
+HELPERS = {}            # Names added to the namespace of every execution, see `preload`
+KILL_GRACE = 1  # Seconds after the timeout before killing an execution that ignores its alarm
+MAX_OUTPUT = 64 * 1024  # Characters kept from the start of each output stream
+OUTPUT_TAIL = 4 * 1024  # Characters kept from the end of a truncated stream, where a traceback ends
+
+class CappedIO(io.StringIO):
+    """Captured output keeping only its first and last characters, so that memory stays bounded."""
+
+    def __init__(self):
+        super().__init__()
+        self._size = 0
+        self._tail = ""
+        self._dropped = 0   # Characters past the head, the tail included
+
+    def write(self, s: str) -> int:
+        written = len(s)
+        room = MAX_OUTPUT - self._size
+        if room > 0:
+            self._size += super().write(s[:room])
+            s = s[room:]
+        if s:
+            self._dropped += len(s)
+            self._tail = (self._tail + s)[-OUTPUT_TAIL:]
+        return written
+
+    def getvalue(self) -> str:
+        dropped = self._dropped - len(self._tail)
+        if not dropped:
+            return super().getvalue() + self._tail
+        return f"{super().getvalue()}\n...[truncated {dropped} characters]\n{self._tail}"
+
+def preload():
+    """Import the libraries used by the generated code, once for all the executions."""
+    for module in PRELOAD:
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+
+    if os.getenv("AGENT_ENABLE_NUMBA") == "1":     # Opt-in JIT helpers, available without imports
+        try:
+            from numba import njit, prange
+            HELPERS.update(njit=njit, prange=prange)
+        except ImportError:     # The code runs without them, as when not enabled
+            pass
+
+def execute(code: str, cwd: str, bytecode: bytes | None = None, env: dict[str, str] | None = None) -> dict:
+    """Execute the code in a fresh namespace, with `cwd` as working directory.
+
+    Args:
+        code (str): The code to execute.
+        cwd (str): The working directory of the execution.
+        bytecode (bytes | None): The marshalled code object of `code`, compiled here if None.
+        env (dict[str, str] | None): Variables added to the environment of the execution.
+
+    Returns:
+        dict: The result of the execution, with keys `success`, `stdout` and `stderr`.
+    """
+    os.chdir(cwd)
+    os.environ["HOME"] = cwd    # Same isolation as the one-shot subprocess
+    os.environ.update(env or {})
+
+    linecache.cache["script.py"] = (len(code), None, code.splitlines(True), "script.py")   # Source lines in the tracebacks
+
+    stdout, stderr = CappedIO(), CappedIO()
+    success = True
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        try:
+            compiled = marshal.loads(bytecode) if bytecode else compile(code, "script.py", "exec")
+            exec(compiled, {"__name__": "__main__", **HELPERS})   # Injected, the source and its line numbers are left untouched
+        except SystemExit as e:
+            success = e.code in (None, 0)
+        except BaseException as e:
+            success = False
+            # Skip the kernel frame, the traceback starts from the executed code as in a script
+            stderr.write("".join(traceback.format_exception(type(e), e, e.__traceback__.tb_next)))
+
+    return {"success": success, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+def spawn(code: str, cwd: str, bytecode: bytes | None = None, env: dict[str, str] | None = None, timeout: int | None = None, memory_limit: int | None = None, inherited: tuple[int, ...] = ()) -> tuple[int, int]:
+    """Execute the code in a forked child with resource limits, see `execute`.
+
+    Args:
+        code (str): The code to execute.
+        cwd (str): The working directory of the execution.
+        bytecode (bytes | None): The marshalled code object of `code`, compiled in the child if None.
+        env (dict[str, str] | None): Variables added to the environment of the execution.
+        timeout (int | None): Maximum wall-clock time in seconds, unlimited if None.
+        memory_limit (int | None): Maximum address space in bytes, unlimited if None.
+        inherited (tuple[int, ...]): File descriptors of the kernel, closed in the child.
+
+    Returns:
+        tuple[int, int]: The pid of the child and the file descriptor its result is read from.
+    """
+    import resource
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:    # Child: execute and report the result on the pipe, never return to the request loop
+        try:
+            os.close(read_fd)
+            for fd in inherited:    # The kernel channels must not outlive the kernel through the child
+                os.close(fd)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)   # Terminate the child when the alarm fires
+            if memory_limit:
+                resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+            if timeout:
+                # CPU time adds up over the threads: a multithreaded execution within its wall-clock
+                # budget must not hit the limit, which only stops the code escaping its alarm
+                cpu_limit = timeout * (os.cpu_count() or 1)
+                resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 1))
+                signal.alarm(timeout)
+            result = execute(code, cwd, bytecode, env)
+            with os.fdopen(write_fd, "w") as out:
+                out.write(json.dumps(result))
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    return pid, read_fd
+
+def collect(pid: int, data: bytes, deadline: float | None = None) -> dict:
+    """Reap the child once its result pipe is closed, and decode its result.
+
+    Args:
+        pid (int): The pid of the child.
+        data (bytes): Everything read from the result pipe.
+        deadline (float | None): Monotonic time after which the child is killed if still running.
+
+    Returns:
+        dict: The result of the execution, `{"timed_out": True}` if a time limit was exceeded, or
+            `{"crashed": True}` if the child died without reporting a result.
+    """
+    # The pipe is closed just before the child exits, unless the executed code closed it
+    reaped, status = os.waitpid(pid, os.WNOHANG)
+    while not reaped and deadline is not None and time.monotonic() < deadline:
+        time.sleep(0.001)
+        reaped, status = os.waitpid(pid, os.WNOHANG)
+    if not reaped:
+        if deadline is not None:
+            os.kill(pid, signal.SIGKILL)
+        _, status = os.waitpid(pid, 0)
+
+    if os.WIFEXITED(status) and data:
+        return json.loads(data)
+    if os.WIFSIGNALED(status) and os.WTERMSIG(status) in (signal.SIGALRM, signal.SIGXCPU, signal.SIGKILL):
+        return {"timed_out": True}
+    return {"crashed": True}
+
+def main():
+    # Keep a private channel for the protocol, so that output written directly on the
+    # file descriptors by the executed code cannot corrupt it
+    protocol_in = os.dup(0)
+    protocol_out = os.fdopen(os.dup(1), "w")
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    sys.stdin = io.StringIO()
+
+    preload()
+    protocol_out.write(json.dumps({"ready": True}) + "\n")
+    protocol_out.flush()
+
+    def respond(request_id: int, result: dict):
+        protocol_out.write(json.dumps({"id": request_id, **result}) + "\n")
+        protocol_out.flush()
+
+    running = {}    # Result pipe of each running child: request id, pid, kill deadline and output
+    buffer = b""
+    while True:
+        deadlines = [execution["deadline"] for execution in running.values() if execution["deadline"]]
+        wait = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+        ready, _, _ = select.select([protocol_in, *running], [], [], wait)
+
+        for fd in ready:
+            if fd != protocol_in:
+                chunk = os.read(fd, 65536)
+                if chunk:
+                    running[fd]["output"] += chunk
+                    continue
+                execution = running.pop(fd)     # Pipe closed, the child is exiting
+                os.close(fd)
+                respond(execution["id"], collect(execution["pid"], bytes(execution["output"]), execution["deadline"]))
+                continue
+
+            data = os.read(protocol_in, 65536)
+            if not data:    # The client is gone
+                for execution in running.values():
+                    os.kill(execution["pid"], signal.SIGKILL)
+                return
+            *lines, buffer = (buffer + data).split(b"\n")
+            for line in lines:
+                request = json.loads(line)
+                bytecode = base64.b64decode(request["bytecode"]) if request.get("bytecode") else None
+                if not hasattr(os, "fork"):
+                    respond(request["id"], execute(request["code"], request["cwd"], bytecode, request.get("env")))
+                    continue
+                timeout = request.get("timeout")
+                pid, result_fd = spawn(
+                    request["code"], request["cwd"], bytecode, request.get("env"), timeout, request.get("memory_limit"),
+                    inherited=(protocol_in, protocol_out.fileno(), *running)
+                )
+                running[result_fd] = {
+                    "id": request["id"],
+                    "pid": pid,
+                    "deadline": time.monotonic() + timeout + KILL_GRACE if timeout else None,
+                    "output": bytearray()
+                }
+
+        now = time.monotonic()
+        for fd, execution in list(running.items()):
+            if execution["deadline"] and now >= execution["deadline"]:
+                os.kill(execution["pid"], signal.SIGKILL)   # Host-side termination, the child cannot escape it
+                del running[fd]
+                os.close(fd)
+                respond(execution["id"], collect(execution["pid"], b""))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+from pathlib import Path
+import subprocess
+import itertools
+import threading
+import queue
+import base64
+import atexit
+import json
+import sys
+import logging
+
+from . import kernel
+
+logger = logging.getLogger(__name__)
+
+KERNEL_PATH = Path(__file__).with_name("kernel.py")
+# Seconds after the timeout before the client gives up on the kernel and kills it: longer than the
+# grace after which the kernel itself kills a timed out execution, so that it can report it first
+CLIENT_BACKSTOP_GRACE = kernel.KILL_GRACE + 1
+
+class ClientTimeoutError(TimeoutError):
+    """The kernel did not answer within the timeout and its grace period, and was killed."""
+
+class ExecutionCrashedError(RuntimeError):
+    """The execution, or the kernel running it, died without reporting a result."""
+
+class PersistentExecutor:
+    """
+    Long-lived kernel process executing code requests, so that interpreter startup and
+    heavy library imports are paid once instead of at every execution.
+
+    The kernel forks a child per execution, so requests from several threads run concurrently
+    on the same preloaded libraries; responses are matched to requests by id.
+
+    Attributes:
+        startup_timeout (int): Maximum time in seconds to wait for the kernel to be ready.
+        max_concurrency (int): Maximum number of executions running at the same time.
+    """
+
+    def __init__(self, startup_timeout: int = 60, max_concurrency: int = 2):
+        self.startup_timeout = startup_timeout
+        self.max_concurrency = max_concurrency
+        self._process: subprocess.Popen | None = None
+        self._ready = threading.Event()
+        self._waiting: dict[int, queue.Queue] = {}      # Response queue of each request in flight
+        self._ids = itertools.count()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()   # Kernel start/stop and writes on its stdin
+        atexit.register(self.close)
+
+    def start(self):
+        """Start the kernel, without waiting: the libraries are preloaded in the background."""
+        with self._lock:
+            if self._process is not None and self._process.poll() is None:
+                return
+            self._process = subprocess.Popen(
+                [sys.executable, "-I", "-u", str(KERNEL_PATH)],    # Isolated: no user site, no PYTHON* variables
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True
+            )
+            self._ready = threading.Event()
+            self._waiting = {}
+            threading.Thread(target=self._read_responses, args=(self._process, self._ready, self._waiting), daemon=True).start()
+
+    @staticmethod
+    def _read_responses(process: subprocess.Popen, ready: threading.Event, waiting: dict[int, queue.Queue]):
+        """Dispatch the responses of the kernel to the waiting requests, until the kernel exits."""
+        for line in process.stdout:
+            response = json.loads(line)
+            if "id" not in response:    # Libraries preloaded
+                ready.set()
+                continue
+            response_queue = waiting.pop(response.pop("id"), None)
+            if response_queue is not None:
+                response_queue.put(response)
+
+        for response_queue in list(waiting.values()):   # The kernel died, nothing else will come
+            response_queue.put(None)
+        waiting.clear()
+
+    def _wait_ready(self):
+        """Wait until the kernel has preloaded the libraries."""
+        if not self._ready.wait(self.startup_timeout):
+            self.close()
+            raise RuntimeError("Execution kernel failed to start.")
+        logger.info("Execution kernel started (pid %d)", self._process.pid)
+
+    def run(self, code: str, cwd: str, timeout: int, memory_limit: int | None = None, bytecode: bytes | None = None, env: dict[str, str] | None = None) -> dict:
+        """Execute the code in the kernel.
+
+        Args:
+            code (str): The code to execute.
+            cwd (str): The working directory of the execution.
+            timeout (int): Maximum time in seconds to allow for the execution.
+            memory_limit (int | None): Maximum address space in bytes of the execution, unlimited if None.
+            bytecode (bytes | None): The marshalled code object of `code`, to skip its compilation in the kernel.
+            env (dict[str, str] | None): Variables added to the environment of the execution.
+
+        Returns:
+            dict: A dictionary with keys `success` (bool), `stdout` (str) and `stderr` (str).
+
+        Raises:
+            TimeoutError: If the execution does not complete in time, it is killed by the kernel.
+            ExecutionCrashedError: If the execution or the kernel dies without a result.
+            ClientTimeoutError: If the kernel does not answer in time, it is killed and replaced.
+        """
+        with self._slots:
+            self.start()
+            if not self._ready.is_set():
+                self._wait_ready()
+
+            request_id = next(self._ids)
+            request = {
+                "id": request_id,
+                "code": code,   # Still sent for the source lines in the tracebacks
+                "bytecode": base64.b64encode(bytecode).decode() if bytecode else None,
+                "cwd": cwd,
+                "env": env,
+                "timeout": timeout,
+                "memory_limit": memory_limit
+            }
+            response_queue = queue.Queue(maxsize=1)
+            with self._lock:
+                process = self._process
+                self._waiting[request_id] = response_queue
+                try:
+                    process.stdin.write(json.dumps(request) + "\n")
+                    process.stdin.flush()
+                except (AttributeError, BrokenPipeError, ValueError):   # The kernel died or was closed, reported below
+                    self._waiting.pop(request_id, None)
+                    response_queue.put(None)
+
+            try:
+                # The kernel enforces the timeout itself, this is a backstop against a stuck kernel
+                result = response_queue.get(timeout=timeout + CLIENT_BACKSTOP_GRACE)
+            except queue.Empty:
+                self.close(process)     # The kernel is stuck, replace it
+                self.start()
+                raise ClientTimeoutError from None
+
+            if result is None:  # The kernel died, e.g. killed as stuck while running another request
+                self.close(process)
+                raise ExecutionCrashedError("Execution process exited unexpectedly.")
+            if result.get("timed_out"):
+                raise TimeoutError
+            if result.get("crashed"):
+                raise ExecutionCrashedError("Execution process exited unexpectedly.")
+            return result
+
+    def close(self, process: subprocess.Popen | None = None):
+        """Terminate the kernel, if running, and if it is still `process` when given."""
+        with self._lock:
+            if self._process is not None and process in (None, self._process):
+                self._process.kill()
+                self._process.wait()
+                self._process = None
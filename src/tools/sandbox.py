@@ -1,12 +1,184 @@
+from collections import OrderedDict
 import subprocess
+import selectors
 import tempfile
+import atexit
+import shutil
+import asyncio
+import importlib.util
+import threading
+import itertools
+import hashlib
+import time
+import marshal
+import ast
 import sys
 import os
 from pathlib import Path
 import logging
 
+import diskcache
+
+from .persistent_executor import PersistentExecutor, ClientTimeoutError, ExecutionCrashedError
+
 logger = logging.getLogger(__name__)
 
+# Opt-in JIT helpers injected in the namespace of the generated code, off by default to avoid
+# the numba import cost, and only enabled if numba is installed
+ENABLE_NUMBA = os.getenv("AGENT_ENABLE_NUMBA") == "1" and importlib.util.find_spec("numba") is not None
+
+# Runs the code read from stdin as `python -` does, with the helpers in its namespace and the
+# line numbers of the source untouched; the traceback starts from the executed code
+_HELPERS_SHIM = """
+import sys, traceback
+namespace = {"__name__": "__main__"}
+try:
+    from numba import njit, prange
+    namespace.update(njit=njit, prange=prange)
+except ImportError:
+    pass
+try:
+    exec(compile(sys.stdin.read(), "<stdin>", "exec"), namespace)
+except SystemExit:
+    raise
+except BaseException as e:
+    traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+    sys.exit(1)
+"""
+
+CACHE_EXPIRE = 3600     # Seconds a cached execution result stays valid
+CODE_CACHE_SIZE = 128   # Compiled code objects kept in memory
+RESULT_CACHE_SIZE = 128 # Execution results kept in memory in front of the disk cache
+TERMINATE_GRACE = 1     # Seconds a timed out one-shot interpreter is given to exit before being killed
+MAX_OUTPUT_BYTES = 64 * 1024    # Bytes kept from the start of each output stream
+OUTPUT_TAIL_BYTES = 4 * 1024    # Bytes kept from the end of a truncated stream, where a traceback ends
+
+_PLOT_SEQ = itertools.count()   # Plot names unique within the process, even for executions in the same second
+
+# Modules whose use makes the output of the code change between executions
+NONDETERMINISTIC_MODULES = {"time", "datetime", "random", "secrets", "uuid", "requests", "urllib", "http", "socket"}
+# Functions returning the time or random values, whatever the module they are imported from
+NONDETERMINISTIC_ATTRIBUTES = {"now", "today", "utcnow", "urandom", "sample", "shuffle", "permutation", "default_rng", "uuid4"}
+
+class _CappedBuffer:
+    """Output of a pipe, keeping only its first and last bytes so that memory stays bounded."""
+
+    def __init__(self):
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.dropped = 0    # Bytes past the head, the tail included
+
+    def write(self, chunk: bytes):
+        room = MAX_OUTPUT_BYTES - len(self.head)
+        if room > 0:
+            self.head += chunk[:room]
+            chunk = chunk[room:]
+        if chunk:
+            self.dropped += len(chunk)
+            self.tail += chunk
+            del self.tail[:-OUTPUT_TAIL_BYTES]
+
+    def getvalue(self) -> bytes:
+        dropped = self.dropped - len(self.tail)
+        if not dropped:
+            return bytes(self.head + self.tail)
+        return bytes(self.head) + f"\n...[truncated {dropped} bytes]\n".encode() + bytes(self.tail)
+
+def cache_key(code: str) -> str:
+    """Content address of the code, exactly as it is executed."""
+    return hashlib.sha256(code.encode()).hexdigest()
+
+def is_deterministic(code: str) -> bool:
+    """Whether the code output can be reused, i.e. it parses and does not use time, randomness or network."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return False
+
+    nondeterministic = NONDETERMINISTIC_MODULES | NONDETERMINISTIC_ATTRIBUTES
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):     # e.g. `from numpy.random import default_rng`, `from os import urandom`
+            names = [node.module or "", *(alias.name for alias in node.names)]
+        elif isinstance(node, ast.Attribute):      # e.g. `np.random`, `pd.Timestamp.now`, `df.sample`
+            names = [node.attr]
+        else:
+            continue
+        if any(part in nondeterministic for name in names for part in name.split(".")):
+            return False
+    return True
+
+# Names through which the code can observe its own variable names or docstrings
+NAME_INTROSPECTION = {"locals", "globals", "vars", "dir", "eval", "exec", "query", "__doc__"}
+
+class _Normalizer(ast.NodeTransformer):
+    """Strip the docstrings and rename the given variables."""
+
+    def __init__(self, renames: dict[str, str]):
+        self.renames = renames
+
+    def _strip_docstring(self, node):
+        body = node.body
+        if body and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant) and isinstance(body[0].value.value, str):
+            node.body = body[1:] or [ast.Pass()]
+        return self.generic_visit(node)
+
+    visit_Module = visit_FunctionDef = visit_AsyncFunctionDef = _strip_docstring
+
+    def visit_Name(self, node):
+        node.id = self.renames.get(node.id, node.id)
+        return node
+
+    def visit_Global(self, node):
+        node.names = [self.renames.get(name, name) for name in node.names]
+        return node
+
+    visit_Nonlocal = visit_Global
+
+def normalized_cache_key(code: str) -> str | None:
+    """Content address of the code insensitive to comments, docstrings and variable names.
+
+    Only the variables bound by assignments are renamed (in order of appearance), never arguments,
+    functions or imports, which can be referenced by name from outside the code.
+
+    Returns:
+        str | None: The key, or None if renaming could change the behavior of the code.
+    """
+    try:
+        tree = ast.parse(code)     # Indented code fails to run, it must not share the key of its dedented version
+    except SyntaxError:
+        return None
+
+    assigned, bound, identifiers = {}, set(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.ClassDef, ast.Match)):    # Class attributes and match captures are bound by name
+            return None
+        if isinstance(node, ast.Name):
+            if node.id in NAME_INTROSPECTION:
+                return None
+            identifiers.add(node.id)
+            if isinstance(node.ctx, ast.Store):
+                assigned.setdefault(node.id, None)
+        elif isinstance(node, ast.Attribute) and node.attr in NAME_INTROSPECTION:
+            return None
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            bound.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            bound.update((alias.asname or alias.name).split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            bound.add(node.name)
+
+    names = [name for name in assigned if name not in bound and not name.startswith("__")]
+    renames = {name: f"_v{i}" for i, name in enumerate(names)}
+    if identifiers & set(renames.values()):    # The new names must not clash with existing ones
+        return None
+
+    normalized = ast.unparse(_Normalizer(renames).visit(tree))
+    return hashlib.sha256(f"ast:{normalized}".encode()).hexdigest()
+
 class CodeSandbox:
     """
     A sandbox environment to safely execute generated code.
@@ -14,18 +186,193 @@ class CodeSandbox:
     Attributes:
         timeout (int): Maximum time in seconds to allow for code execution.
         output_dir (str): Directory to save any generated output files 
+        persistent (bool): Whether to execute the code in a persistent kernel with preloaded libraries, instead of a new interpreter per execution.
+        cache (bool): Whether to reuse the results of previous executions of the same code, stored in `output_dir/.exec_cache`.
+        workers (int): Number of executions that can run concurrently, each in a child forked from the persistent kernel.
+        concurrency_limit (int): Maximum number of concurrent executions in a batch, i.e. `workers`.
+        memory_limit (int | None): Maximum address space in bytes of a persistent kernel execution, unlimited if None.
     """
 
-    def __init__(self, timeout: int = 30, output_dir: str = "output"):
+    def __init__(self, timeout: int = 30, output_dir: str = "output", persistent: bool = os.name == "posix", cache: bool = True, workers: int = 2, memory_limit: int | None = 4 * 1024**3):
         self.timeout = timeout
+        self.memory_limit = memory_limit
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(exist_ok=True)
+        self.persistent = persistent
+        self.concurrency_limit = workers
+        self._executor = PersistentExecutor(max_concurrency=workers) if persistent else None
+        if self._executor:
+            self._executor.start()  # The kernel warms up in the background
+        self._cache = diskcache.Cache(str(self.output_dir / ".exec_cache")) if cache else None
+        self._results: OrderedDict[str, tuple[float | None, dict, Path | None]] = OrderedDict()    # LRU of expiry, result and plot of recent executions
+        self._results_lock = threading.Lock()
+        self._code_cache: OrderedDict[str, bytes] = OrderedDict()    # LRU of marshalled code objects
+        self._code_cache_lock = threading.Lock()
+        self._workdirs: list[Path] = []     # Idle working directories, reused across executions
+        self._workdirs_lock = threading.Lock()
+        self._timeout_set: set[str] = set()     # Cache keys of the code that timed out in this session
+
+    def _new_plot_path(self) -> Path:
+        """Path of a new plot in the output directory."""
+        plot_name = f"plot_{os.getpid()}_{next(_PLOT_SEQ)}.html"     # Unique across processes sharing the directory
+        return self.output_dir / plot_name
+
+    def _lease_workdir(self) -> Path:
+        """Empty working directory for an execution, one per concurrent execution."""
+        with self._workdirs_lock:
+            if self._workdirs:
+                return self._workdirs.pop()
+        workdir = Path(tempfile.mkdtemp(prefix="react_sbx_"))
+        atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+        return workdir
+
+    def _release_workdir(self, workdir: Path):
+        """Empty the working directory and make it available to the next execution."""
+        for entry in os.scandir(workdir):   # Usually empty, the plot has already been moved
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.unlink(entry.path)
+        with self._workdirs_lock:
+            self._workdirs.append(workdir)
+
+    def _recall(self, key: str) -> dict | None:
+        """Result of a recent execution from the in-memory cache, with its own copy of the plot.
+
+        None if not cached in memory, so that the disk cache is looked up.
+        """
+        with self._results_lock:
+            entry = self._results.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] <= time.time():   # Expired with its disk cache entry
+                del self._results[key]
+                return None
+            self._results.move_to_end(key)
+
+        _, result, plot_source = entry
+        plot_path = None
+        if plot_source is not None:     # Each hit gets its own copy of the plot
+            plot_path = self._new_plot_path()
+            try:
+                shutil.copyfile(plot_source, plot_path)
+            except OSError:     # The plot was deleted, the disk cache still has it
+                with self._results_lock:
+                    self._results.pop(key, None)
+                return None
+        return {**result, "plot_path": str(plot_path) if plot_path else None}
+
+    def _remember(self, key: str, result: dict, expire_time: float | None):
+        """Keep the result in the in-memory cache until `expire_time` (never expires if None), with the plot referenced by path."""
+        plot_path = result["plot_path"]
+        entry = {"success": result["success"], "stdout": result["stdout"], "stderr": result["stderr"]}
+        with self._results_lock:
+            self._results[key] = (expire_time, entry, Path(plot_path) if plot_path else None)
+            self._results.move_to_end(key)
+            if len(self._results) > RESULT_CACHE_SIZE:
+                self._results.popitem(last=False)
+
+    def _compile(self, code: str) -> bytes | None:
+        """Marshalled code object of the code, compiled once per source.
 
-    def execute_code(self, code: str):
+        None if the code does not compile, so that the kernel reports the error as the execution would.
+        """
+        key = hashlib.blake2b(code.encode(), digest_size=16).hexdigest()
+        with self._code_cache_lock:
+            bytecode = self._code_cache.get(key)
+            if bytecode is not None:
+                self._code_cache.move_to_end(key)
+                return bytecode
+
+        try:
+            bytecode = marshal.dumps(compile(code, "script.py", "exec"))
+        except (SyntaxError, ValueError):
+            return None
+
+        with self._code_cache_lock:
+            self._code_cache[key] = bytecode
+            if len(self._code_cache) > CODE_CACHE_SIZE:
+                self._code_cache.popitem(last=False)
+        return bytecode
+
+    def _run_subprocess(self, code: str, temp_dir: str, env: dict[str, str]) -> dict:
+        """Execute the code in a new Python interpreter."""
+        process = subprocess.Popen(
+            # Use the current Python interpreter, isolated, reading the code from stdin
+            [sys.executable, "-I", "-c", _HELPERS_SHIM] if ENABLE_NUMBA else [sys.executable, "-I", "-"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=temp_dir,               # Set the temp directory as the working directory
+            env={
+                **os.environ,  
+                "HOME": temp_dir,           # Override HOME to `temp_dir` for isolation
+                **env
+            }
+        )
+        with process:
+            try:
+                if os.name == "posix":
+                    stdout, stderr = self._stream_output(process, code.encode())
+                else:   # Pipes cannot be selected on Windows
+                    stdout, stderr = process.communicate(code.encode(), timeout=self.timeout)
+                    stdout, stderr = self._capped(stdout), self._capped(stderr)
+            except subprocess.TimeoutExpired:
+                process.terminate()     # Let the interpreter exit, then kill it after a short grace period
+                try:
+                    process.wait(timeout=TERMINATE_GRACE)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+                raise
+
+        logger.info(f"Return code: {process.returncode}")
+
+        return {
+            "success": process.returncode == 0,
+            "stdout": stdout.decode(errors="replace"),
+            "stderr": stderr.decode(errors="replace")
+        }
+
+    @staticmethod
+    def _capped(data: bytes) -> bytes:
+        """Truncate the output read at once, as `_stream_output` does while reading."""
+        buffer = _CappedBuffer()
+        buffer.write(data)
+        return buffer.getvalue()
+
+    def _stream_output(self, process: subprocess.Popen, code: bytes) -> tuple[bytes, bytes]:
+        """Send the code to the process and read its output as it is produced, until exit or timeout.
+        The pipes are drained to the end, but only the start and end of each stream are kept."""
+        deadline = time.monotonic() + self.timeout
+        process.stdin.write(code)   # Read entirely by the interpreter before executing
+        process.stdin.close()
+
+        output = {process.stdout: _CappedBuffer(), process.stderr: _CappedBuffer()}
+        with selectors.DefaultSelector() as selector:
+            for pipe in output:
+                selector.register(pipe, selectors.EVENT_READ)
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired(process.args, self.timeout)
+                for key, _ in selector.select(remaining):
+                    chunk = os.read(key.fd, 65536)
+                    if chunk:
+                        output[key.fileobj].write(chunk)
+                    else:   # Pipe closed
+                        selector.unregister(key.fileobj)
+
+        process.wait(timeout=max(deadline - time.monotonic(), 0))
+        return output[process.stdout].getvalue(), output[process.stderr].getvalue()
+
+    def execute_code(self, code: str, cacheable: bool = True):
         """Execute the given code in a sandboxed environment.
 
         Args:
             code (str): The code to execute.
+            cacheable (bool): Whether the result can be served from, and stored in, the execution cache. 
+                Code using time, randomness or network is never cached.
 
         Returns:
             dict: A dictionary containing execution output and any generated files. The keys of the dictionary are: 
@@ -35,52 +382,115 @@ class CodeSandbox:
                 - `plot_path` (str | None).
         """    
 
-        # Create a temporary directory for code execution
-        with tempfile.TemporaryDirectory() as temp_dir:
-            code_file = Path(temp_dir) / "script.py"
-            code_file.write_text(code)
+        key = cache_key(code)
+        if key in self._timeout_set:    # Running it again would most likely time out again
+            logger.info("Skipping code that previously timed out")
+            return {
+                "success": False,
+                "stdout": "",
+                "stderr": f"Skipped: a previous run of the same code timed out ({self.timeout}s).",
+                "plot_path": None
+            }
+
+        alias = None    # Key of the normalized code, pointing to the key of a successful execution
+        cacheable = self._cache is not None and cacheable and is_deterministic(code)
+        if cacheable:
+            result = self._recall(key)     # No unpickling for the recent code
+            if result is not None:
+                logger.info("Execution cache hit (memory)")
+                return result
+            cached, expire_time = self._cache.get(key, expire_time=True)
+            if cached is not None:
+                logger.info("Execution cache hit")
+            elif (alias := normalized_cache_key(code)) is not None:
+                cached, expire_time = self._cache.get(self._cache.get(alias, ""), expire_time=True)
+                if cached is not None:
+                    logger.info("Execution cache semantic_hit")
+            if cached is not None:
+                plot_path = None
+                if cached["plot_html"] is not None:     # Each hit gets its own copy of the plot
+                    plot_path = self._new_plot_path()
+                    plot_path.write_bytes(cached["plot_html"])
+                result = {
+                    "success": cached["success"],
+                    "stdout": cached["stdout"],
+                    "stderr": cached["stderr"],
+                    "plot_path": str(plot_path) if plot_path else None
+                }
+                self._remember(key, result, expire_time)
+                return result
 
+        # Lease a working directory for code execution
+        workdir = self._lease_workdir()
+        temp_dir = str(workdir)
+        target = self._new_plot_path()
+        env = {"SANDBOX_PLOT_PATH": str(target.absolute())}  # The code writes its plot in place, no move needed
+        try:
             try:
-                result = subprocess.run(
-                    [sys.executable, str(code_file)],   # Use the current Python interpreter to run the script
-                    cwd=temp_dir,               # Set the temp directory as the working directory
-                    timeout=self.timeout,       
-                    capture_output=True,        
-                    text=True,
-                    env={
-                        **os.environ,  
-                        "HOME": temp_dir,           # Override HOME to `temp_dir` for isolation
-                    }
-                )
-
-                logger.info(f"Return code: {result.returncode}")
-                logger.info(f"Stdout length: {len(result.stdout)}")
-                logger.info(f"Stderr length: {len(result.stderr)}")
-
-                plot_path = None    
+                if self._executor:
+                    result = self._executor.run(code, cwd=temp_dir, timeout=self.timeout, memory_limit=self.memory_limit, bytecode=self._compile(code), env=env)
+                else:
+                    result = self._run_subprocess(code, temp_dir, env)
+
+                logger.info(f"Stdout length: {len(result['stdout'])}")
+                logger.info(f"Stderr length: {len(result['stderr'])}")
+
+                plot_path = None
                 output_file = Path(temp_dir) / "output.html"        
-                if output_file.exists():
-                    import time
-                    plot_name = f"plot_{int(time.time())}.html"     # Setting unique name based on timestamp
-                    plot_path = self.output_dir / plot_name         # Move the plot to the predefined output directory
-                    output_file.rename(plot_path)                   
+                if output_file.exists():    # Code saving its plot under the default name, move it to the output directory
+                    plot_path = Path(shutil.move(output_file, target))  # Copies when the directories are on different filesystems
+                elif target.exists():
+                    plot_path = target
 
                 logger.info(f"Code executed successfully. Output path: {plot_path}")
 
-                return {
-                    "success": result.returncode == 0,
-                    "stdout": result.stdout,
-                    "stderr": result.stderr,
+                result = {
+                    **result,
                     "plot_path": str(plot_path) if plot_path else None
                 }
+                if cacheable:
+                    self._cache.set(key, {
+                        "success": result["success"],
+                        "stdout": result["stdout"],
+                        "stderr": result["stderr"],
+                        "plot_html": plot_path.read_bytes() if plot_path else None
+                    }, expire=CACHE_EXPIRE)
+                    if alias is not None and result["success"]:     # A failure's traceback is specific to its source
+                        self._cache.set(alias, key, expire=CACHE_EXPIRE)
+                    self._remember(key, result, time.time() + CACHE_EXPIRE)
+
+                return result
             
-            except subprocess.TimeoutExpired:
+            except ClientTimeoutError:
+                logger.error(f"Execution kernel did not answer. {self.timeout}s elapsed.")
+                self._timeout_set.add(key)
+                target.unlink(missing_ok=True)  # Plot possibly left half-written by the killed execution
+
+                return {
+                    "success": False,
+                    "stdout": "",
+                    "stderr": f"Client timed out after {self.timeout}s.",
+                    "plot_path": None
+                }
+            except (subprocess.TimeoutExpired, TimeoutError):
                 logger.error(f"Code execution timed out. {self.timeout}s elapsed.")
+                self._timeout_set.add(key)
+                target.unlink(missing_ok=True)
 
                 return {
                     "success": False,   
                     "stdout": "",
-                    "stderr": "Execution timeout expired ({self.timeout}s).",
+                    "stderr": f"Execution timeout expired ({self.timeout}s).",
+                    "plot_path": None
+                }
+            except ExecutionCrashedError as e:     # Not an outcome of the code itself, e.g. the kernel was replaced, never cached
+                logger.error("Execution died without a result")
+                target.unlink(missing_ok=True)
+
+                return {
+                    "success": False,
+                    "stdout": "",
+                    "stderr": str(e),
                     "plot_path": None
                 }
             except Exception as e:
@@ -91,4 +501,17 @@ class CodeSandbox:
                     "stdout": "",
                     "stderr": str(e),
                     "plot_path": None
-                }
\ No newline at end of file
+                }
+        finally:
+            self._release_workdir(workdir)
+
+    def clear_timeouts(self):
+        """Allow the code that previously timed out to be executed again, e.g. between sessions."""
+        self._timeout_set.clear()
+
+    async def execute_code_async(self, code: str, cacheable: bool = True) -> dict:
+        """Asynchronous version of `execute_code`, see its documentation.
+
+        The execution runs in a worker thread, so that concurrent calls overlap in the kernel.
+        """
+        return await asyncio.to_thread(self.execute_code, code, cacheable)
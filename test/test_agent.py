@@ -0,0 +1,157 @@
+from contextlib import closing
+import asyncio
+import sqlite3
+import json
+
+import numpy as np
+import pytest
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage, ToolMessage
+
+from src.adapters.plan_cache import PlanCache
+from src.agent import react_agent
+from src.agent.react_agent import DataAnalysisAgent, _compact
+
+class FakeModel:
+    """Bound chat model streaming scripted responses, one list of chunks per call"""
+
+    def __init__(self, responses: list[list[AIMessageChunk]]):
+        self.responses = list(responses)
+        self.calls = []     # Messages of each call
+        self.streamed = 0   # Chunks consumed by the agent
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    async def astream(self, messages):
+        self.calls.append(messages)
+        for chunk in self.responses.pop(0):
+            self.streamed += 1
+            yield chunk
+
+def tool_call(code: str, call_id: str, index: int = 0) -> AIMessageChunk:
+    """Chunk requesting the execution of the code"""
+    return AIMessageChunk(content="", tool_call_chunks=[{"name": "execute_python", "args": json.dumps({"code": code}), "id": call_id, "index": index}])
+
+def text(content: str) -> AIMessageChunk:
+    """Chunk with list-of-blocks content, as returned for parts carrying thought signatures"""
+    return AIMessageChunk(content=[{"type": "text", "text": content, "extras": {"signature": "sig"}}])
+
+@pytest.fixture
+def make_agent(monkeypatch):
+    """Build an agent on a fake model, with the executions recorded instead of run"""
+    executed = []
+
+    def run_python_code(code: str) -> str:
+        executed.append(code)
+        plot = f"output/{code}.html" if code.startswith("plot") else None
+        return json.dumps({"ok": True, "out": code, "err": "", "plot": plot})
+
+    monkeypatch.setattr(react_agent, "_BOUND_LLM_CACHE", {})
+    monkeypatch.setattr(react_agent, "run_python_code", run_python_code)
+    monkeypatch.setattr(react_agent, "get_sandbox", lambda: None)
+
+    def make(responses, max_iterations=5, plan_cache=None):
+        model = FakeModel(responses)
+        monkeypatch.setattr(react_agent, "ChatGoogleGenerativeAI", lambda **kwargs: model)
+        return DataAnalysisAgent(max_iterations=max_iterations, plan_cache=plan_cache), model, executed
+    return make
+
+def test_early_stop_on_sentinel(make_agent):
+    """Test that the generation stops at the completion sentinel, with list-of-blocks content"""
+    agent, model, executed = make_agent([[text("The plot is done. TASK_"), text("COMPLETE"), text(" and more")]])
+
+    state = asyncio.run(agent.arun("plot something"))
+
+    assert state["task_complete"] and not executed
+    assert model.streamed == 2     # The last chunk is never consumed
+
+def test_single_tool_call_loop(make_agent):
+    """Test that a tool call is answered with its result, and a plot ends the task"""
+    agent, model, executed = make_agent([[text("Plotting."), tool_call("plot_a", "call_1")]])
+
+    state = asyncio.run(agent.arun("plot something"))
+
+    assert executed == ["plot_a"] and len(model.calls) == 1
+    assert state["task_complete"] and state["plot_path"] == "output/plot_a.html" and state["current_code"] == "plot_a"
+    answer = state["messages"][-1]
+    assert isinstance(answer, ToolMessage) and answer.tool_call_id == "call_1" and json.loads(answer.content)["ok"]
+
+def test_parallel_tool_calls(make_agent):
+    """Test that the tool calls of a response are all executed, answered in their order"""
+    agent, model, executed = make_agent([[tool_call("print_a", "call_1", 0), tool_call("plot_b", "call_2", 1)]])
+
+    state = asyncio.run(agent.arun("plot something"))
+
+    assert sorted(executed) == ["plot_b", "print_a"]
+    answers = [msg for msg in state["messages"] if isinstance(msg, ToolMessage)]
+    assert [answer.tool_call_id for answer in answers] == ["call_1", "call_2"]
+    assert json.loads(answers[0].content)["out"] == "print_a"
+    assert state["plot_path"] == "output/plot_b.html" and state["current_code"] == "plot_b"
+
+def test_inline_code_fallback(make_agent):
+    """Test that code written inline instead of calling the tool is still executed"""
+    agent, model, executed = make_agent([[text("```python\nplot_inline\n```")]])
+
+    state = asyncio.run(agent.arun("plot something"))
+
+    assert executed == ["plot_inline"] and state["plot_path"] == "output/plot_inline.html"
+    assert isinstance(state["messages"][-1], HumanMessage)
+
+def test_iteration_cap(make_agent):
+    """Test that the loop stops at the iteration cap when no plot is produced"""
+    agent, model, executed = make_agent([[tool_call("print_1", "call_1")], [tool_call("print_2", "call_2")]], max_iterations=2)
+
+    state = asyncio.run(agent.arun("plot something"))
+
+    assert executed == ["print_1", "print_2"] and len(model.calls) == 2
+    assert state["iteration"] == 2 and not state["task_complete"] and state["plot_path"] is None
+
+def test_single_iteration_ends_after_observation(make_agent):
+    """Test that the single-iteration graph ends after the first observation"""
+    agent, model, executed = make_agent([[tool_call("print_1", "call_1")]], max_iterations=1)
+
+    state = asyncio.run(agent.arun("plot something"))
+
+    assert executed == ["print_1"] and len(model.calls) == 1 and state["iteration"] == 1
+
+def test_compact_keeps_short_history():
+    """Test that a history with nothing to summarize is returned as is"""
+    messages = [HumanMessage(content="query"), AIMessage(content="thought"), HumanMessage(content="observation")]
+    assert _compact(messages, keep_recent=4) == messages
+
+def test_compact_summarizes_older_steps():
+    """Test that the head and the recent steps are kept verbatim, and the older ones summarized once"""
+    call = {"name": "execute_python", "args": {"code": "print(1)"}, "id": "call_1"}
+    messages = [
+        SystemMessage(content="seed"),
+        HumanMessage(content="query"),
+        AIMessage(content="first thought"),
+        HumanMessage(content="same error"),
+        AIMessage(content="second thought"),
+        HumanMessage(content="same error"),
+        AIMessage(content="", tool_calls=[call]),
+        ToolMessage(content="result", tool_call_id="call_1"),
+        AIMessage(content="last thought"),
+        HumanMessage(content="last observation")
+    ]
+
+    compacted = _compact(messages, keep_recent=3)
+
+    # The tool result at the split keeps the message that requested it
+    assert compacted[:2] == messages[:2] and compacted[3:] == messages[6:]
+    summary = compacted[2].content
+    assert isinstance(compacted[2], HumanMessage) and summary.startswith("Prior steps summary:")
+    assert summary.count("same error") == 1 and "first thought" in summary and "second thought" in summary
+
+def test_plan_stored_once(make_agent, tmp_path):
+    """Test that a plan is stored after a success, and not again when a run was seeded from it"""
+    cache = PlanCache(db_path=str(tmp_path / "plans.db"), embedder=lambda text: np.ones(4))
+    agent, model, executed = make_agent([[tool_call("plot_a", "call_1")], [tool_call("plot_b", "call_2")]], plan_cache=cache)
+
+    asyncio.run(agent.arun("plot something"))
+    assert cache.lookup(cache.embed("plot something")) == "plot_a"
+
+    state = asyncio.run(agent.arun("plot something"))
+    assert isinstance(state["messages"][0], SystemMessage) and "plot_a" in state["messages"][0].content
+    with closing(sqlite3.connect(cache.db_path)) as conn:     # The seeded run stored nothing
+        assert conn.execute("SELECT code_template FROM plans").fetchall() == [("plot_a",)]
@@ -0,0 +1,42 @@
+from contextlib import closing
+import sqlite3
+
+import numpy as np
+
+from src.adapters.plan_cache import PlanCache
+
+def _fake_embedder(text: str) -> np.ndarray:
+    """Bag-of-letters embedding, enough to tell similar queries apart"""
+    vector = np.zeros(26, dtype=np.float32)
+    for char in text.lower():
+        if char.isalpha() and char.isascii():
+            vector[ord(char) - ord("a")] += 1
+    return vector
+
+def test_cache_hit(tmp_path):
+    """Test that a similar query reuses the stored plan"""
+    cache = PlanCache(db_path=str(tmp_path / "plans.db"), embedder=_fake_embedder)
+
+    cache.store(cache.embed("iris scatter plot"), "print('iris')")
+
+    assert cache.lookup(cache.embed("iris scatter plot!")) == "print('iris')"
+
+def test_cache_miss(tmp_path):
+    """Test that an unrelated query does not reuse any plan"""
+    cache = PlanCache(db_path=str(tmp_path / "plans.db"), embedder=_fake_embedder)
+
+    assert cache.lookup(cache.embed("iris scatter plot")) is None
+
+    cache.store(cache.embed("iris scatter plot"), "print('iris')")
+
+    assert cache.lookup(cache.embed("monthly sales volume")) is None
+
+def test_store_skips_duplicate(tmp_path):
+    """Test that storing the same plan again adds no row"""
+    cache = PlanCache(db_path=str(tmp_path / "plans.db"), embedder=_fake_embedder)
+
+    cache.store(cache.embed("iris scatter plot"), "print('iris')")
+    cache.store(cache.embed("iris scatter plot please"), "print('iris')")
+
+    with closing(sqlite3.connect(cache.db_path)) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM plans").fetchone()[0] == 1
@@ -1,27 +1,35 @@
-from src.tools.sandbox import CodeSandbox
+import textwrap
+import asyncio
+import json
+import sys
+import os
 
-def test_simple_execution():
-    """Test basic code execution"""
-    sandbox = CodeSandbox(timeout=10, output_dir="test_output")
-    
-    code = """
+import pytest
+
+from src.tools.sandbox import CodeSandbox, cache_key, is_deterministic, normalized_cache_key
+from src.tools import kernel
+from src.tools.persistent_executor import PersistentExecutor
+from src.tools import sandbox as sandbox_module
+from src.tools.code_executor import MAX_STDERR, MAX_STDOUT, _format_result
+
+@pytest.fixture
+def forbid_execution(monkeypatch):
+    """Function making any further execution fail the test, for the results that must come from the cache"""
+    def fail(*args, **kwargs):
+        raise AssertionError("Code executed instead of served from the cache")
+
+    def forbid():
+        monkeypatch.setattr(PersistentExecutor, "run", fail)
+        monkeypatch.setattr(CodeSandbox, "_run_subprocess", fail)
+    return forbid
+
+SIMPLE_CODE = """
 print("Hello from sandbox!")
 result = 2 + 2
 print(f"2 + 2 = {result}")
 """
-    
-    result = sandbox.execute_code(code)
-    print("Test 1 - Simple execution:")
-    print(f"  Success: {result['success']}")
-    print(f"  Stdout: {result['stdout']}")
-    print(f"  Stderr: {result['stderr']}")
-    print()
 
-def test_plotly_generation():
-    """Test Plotly HTML generation"""
-    sandbox = CodeSandbox(timeout=10, output_dir="test_output")
-    
-    code = """
+PLOTLY_CODE = """
 import plotly.express as px
 import pandas as pd
 
@@ -39,52 +47,20 @@ fig.write_html('output.html')
 
 print("Plot generated successfully")
 """
-    
-    result = sandbox.execute_code(code)
-    print("Test 2 - Plotly generation:")
-    print(f"  Success: {result['success']}")
-    print(f"  Stdout: {result['stdout']}")
-    print(f"  Plot path: {result['plot_path']}")
-    print()
 
-def test_timeout():
-    """Test timeout handling"""
-    sandbox = CodeSandbox(timeout=2, output_dir="test_output")
-    
-    code = """
+TIMEOUT_CODE = """
 import time
 print("Starting long operation...")
 time.sleep(10)  # Will timeout
 print("This won't be printed")
 """
-    
-    result = sandbox.execute_code(code)
-    print("Test 3 - Timeout:")
-    print(f"  Success: {result['success']}")
-    print(f"  Stderr: {result['stderr']}")
-    print()
 
-def test_error_handling():
-    """Test error handling"""
-    sandbox = CodeSandbox(timeout=10, output_dir="test_output")
-    
-    code = """
+ERROR_CODE = """
 print("About to raise error...")
 raise ValueError("Something went wrong!")
 """
-    
-    result = sandbox.execute_code(code)
-    print("Test 4 - Error handling:")
-    print(f"  Success: {result['success']}")
-    print(f"  Stdout: {result['stdout']}")
-    print(f"  Stderr: {result['stderr']}")
-    print()
 
-def test_data_analysis():
-    """Test data analysis code"""
-    sandbox = CodeSandbox(timeout=10, output_dir="test_output")
-    
-    code = """
+DATA_ANALYSIS_CODE = """
 import pandas as pd
 import plotly.express as px
 
@@ -104,23 +80,331 @@ fig.write_html('output.html')
 
 print("\\nAnalysis complete!")
 """
+
+CODES = [SIMPLE_CODE, PLOTLY_CODE, TIMEOUT_CODE, ERROR_CODE, DATA_ANALYSIS_CODE]
+
+@pytest.fixture(scope="module")
+def sandbox(tmp_path_factory):
+    """Sandbox shared by the tests of the module, so that its kernels start once"""
+    return CodeSandbox(timeout=10, output_dir=str(tmp_path_factory.mktemp("sandbox")), cache=False)
+
+def test_simple_execution(sandbox):
+    """Test basic code execution"""
+    result = sandbox.execute_code(SIMPLE_CODE)
+    print("Test 1 - Simple execution:")
+    print(f"  Success: {result['success']}")
+    print(f"  Stdout: {result['stdout']}")
+    print(f"  Stderr: {result['stderr']}")
+    print()
+    assert result["success"] and result["stderr"] == ""
+    assert result["stdout"] == "Hello from sandbox!\n2 + 2 = 4\n"
+    assert result["plot_path"] is None
+
+def test_plotly_generation(sandbox):
+    """Test Plotly HTML generation"""
+    result = sandbox.execute_code(PLOTLY_CODE)
+    print("Test 2 - Plotly generation:")
+    print(f"  Success: {result['success']}")
+    print(f"  Stdout: {result['stdout']}")
+    print(f"  Plot path: {result['plot_path']}")
+    print()
+    assert result["success"] and result["stdout"] == "Plot generated successfully\n"
+    assert os.path.isfile(result["plot_path"]) and "Sample Line Plot" in open(result["plot_path"]).read()
+
+def test_timeout():
+    """Test timeout handling"""
+    sandbox = CodeSandbox(timeout=2, output_dir="test_output", cache=False)
     
-    result = sandbox.execute_code(code)
+    result = sandbox.execute_code(TIMEOUT_CODE)
+    print("Test 3 - Timeout:")
+    print(f"  Success: {result['success']}")
+    print(f"  Stderr: {result['stderr']}")
+    print()
+    assert not result["success"] and result["stderr"] == "Execution timeout expired (2s)."
+    assert result["plot_path"] is None
+
+def test_error_handling(sandbox):
+    """Test error handling"""
+    result = sandbox.execute_code(ERROR_CODE)
+    print("Test 4 - Error handling:")
+    print(f"  Success: {result['success']}")
+    print(f"  Stdout: {result['stdout']}")
+    print(f"  Stderr: {result['stderr']}")
+    print()
+    assert not result["success"] and result["stdout"] == "About to raise error...\n"
+    assert "ValueError: Something went wrong!" in result["stderr"]
+
+def test_data_analysis(sandbox):
+    """Test data analysis code"""
+    result = sandbox.execute_code(DATA_ANALYSIS_CODE)
     print("Test 5 - Data analysis:")
     print(f"  Success: {result['success']}")
     print(f"  Stdout: {result['stdout']}")
     print(f"  Plot path: {result['plot_path']}")
     print()
+    assert result["success"] and result["stdout"].startswith("Data Summary:\n")
+    assert "mean" in result["stdout"] and result["stdout"].endswith("Analysis complete!\n")
+    assert os.path.isfile(result["plot_path"])
+
+def test_persistent_kernel():
+    """Test that the persistent kernel isolates executions and recovers from a timeout"""
+    sandbox = CodeSandbox(timeout=2, output_dir="test_output", persistent=True, cache=False)
+
+    sandbox.execute_code("leaked = 1")
+    result = sandbox.execute_code("print(leaked)")
+    assert not result["success"] and "NameError" in result["stderr"]
+
+    result = sandbox.execute_code("import time\ntime.sleep(10)")
+    assert not result["success"]
+
+    # An execution ignoring its alarm is still killed after the grace period
+    result = sandbox.execute_code("import signal, time\nsignal.signal(signal.SIGALRM, signal.SIG_IGN)\ntime.sleep(10)", cacheable=False)
+    assert not result["success"] and "timeout" in result["stderr"]
+
+    result = sandbox.execute_code("print('recovered')")
+    print("Test 6 - Persistent kernel:")
+    print(f"  Success: {result['success']}")
+    print(f"  Stdout: {result['stdout']}")
+    print()
+    assert result["success"] and result["stdout"] == "recovered\n"
+
+def test_subprocess_execution():
+    """Test the one-shot interpreter path, with output streaming and timeout"""
+    sandbox = CodeSandbox(timeout=2, output_dir="test_output", persistent=False, cache=False)
+
+    result = sandbox.execute_code("import sys\nprint('out')\nsys.stderr.write('err')")
+    assert result["success"] and result["stdout"] == "out\n" and result["stderr"] == "err"
+
+    result = sandbox.execute_code("import time\ntime.sleep(10)")
+    assert not result["success"] and "timeout" in result["stderr"]
+
+def test_timed_out_code_skipped():
+    """Test that code which timed out is not executed again until the timeouts are cleared"""
+    sandbox = CodeSandbox(timeout=1, output_dir="test_output", persistent=False, cache=False)
+    code = "import time\ntime.sleep(10)"
+
+    assert "timeout" in sandbox.execute_code(code)["stderr"]
+    assert sandbox.execute_code(code)["stderr"].startswith("Skipped")
+
+    sandbox.clear_timeouts()
+    assert "timeout" in sandbox.execute_code(code)["stderr"]
+
+def test_forked_execution_limits():
+    """Test that executions cannot alter the kernel and are bounded in memory"""
+    sandbox = CodeSandbox(timeout=10, output_dir="test_output", persistent=True, cache=False, workers=1, memory_limit=1024**3)
+
+    sandbox.execute_code("import pandas as pd\npd.leaked = 1", cacheable=False)
+    result = sandbox.execute_code("import pandas as pd\nprint(hasattr(pd, 'leaked'))", cacheable=False)
+    assert result["stdout"] == "False\n"
+
+    result = sandbox.execute_code("data = bytearray(2 * 1024**3)", cacheable=False)
+    assert not result["success"] and "MemoryError" in result["stderr"]
+
+def test_multithreaded_execution_not_timed_out():
+    """Test that the CPU time of several threads within the wall-clock budget is not taken for a timeout"""
+    sandbox = CodeSandbox(timeout=3, output_dir="test_output", persistent=True, cache=False, workers=1)
+
+    code = """
+import hashlib, os, threading, time
+data = b"x" * (8 * 1024 * 1024)
+def work():     # hashlib releases the GIL, the threads run in parallel
+    end = time.monotonic() + 2
+    while time.monotonic() < end:
+        hashlib.sha256(data).digest()
+threads = [threading.Thread(target=work) for _ in range(max(os.cpu_count() or 1, 2))]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+print("done")
+"""
+    result = sandbox.execute_code(code)
+    assert result["success"] and result["stdout"] == "done\n", result["stderr"]
+
+def test_execution_cache(tmp_path, forbid_execution):
+    """Test that repeated code is served from the cache"""
+    sandbox = CodeSandbox(timeout=10, output_dir=str(tmp_path))
+
+    code = """
+import plotly.express as px
+fig = px.bar(x=['a', 'b'], y=[1, 2])
+fig.write_html('output.html')
+print("cached run")
+"""
+
+    first = sandbox.execute_code(code)
+    first_html = open(first["plot_path"], "rb").read()
+
+    # Indented code does not run, it must not be served the result of its dedented version
+    indented = sandbox.execute_code(textwrap.indent(code, "    "))
+    assert not indented["success"] and "IndentationError" in indented["stderr"]
+
+    forbid_execution()
+    second = sandbox.execute_code(code)
+
+    assert second["success"] and second["stdout"] == first["stdout"]
+    assert second["plot_path"] != first["plot_path"]
+    assert open(second["plot_path"], "rb").read() == first_html
+
+def test_crashed_execution_not_cached(tmp_path):
+    """Test that an execution dying without a result is reported but not cached"""
+    sandbox = CodeSandbox(timeout=10, output_dir=str(tmp_path), persistent=True)
+
+    code = "import os\nos._exit(1)"
+    result = sandbox.execute_code(code)
+    assert not result["success"] and result["stderr"] == "Execution process exited unexpectedly."
+    assert cache_key(code) not in sandbox._cache and not sandbox._results
+
+def test_memory_cache_hit(tmp_path, forbid_execution):
+    """Test that recent results are served from memory, and fall back to the disk cache once evicted"""
+    sandbox = CodeSandbox(timeout=10, output_dir=str(tmp_path))
+
+    code = "open('output.html', 'w').write('<html></html>')\nprint('remembered')"
+    first = sandbox.execute_code(code)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Disk cache read instead of the memory one")
+    disk_get, sandbox._cache.get = sandbox._cache.get, fail
+    forbid_execution()
+    second = sandbox.execute_code(code)
+    assert second["success"] and second["stdout"] == "remembered\n"
+    assert second["plot_path"] != first["plot_path"]
+    assert open(second["plot_path"]).read() == "<html></html>"
+
+    sandbox._results.clear()
+    sandbox._cache.get = disk_get
+    assert sandbox.execute_code(code)["stdout"] == "remembered\n"
+    assert len(sandbox._results) == 1   # Promoted back to memory
+
+def test_workdir_reused_empty():
+    """Test that files written by an execution are not visible to the next one"""
+    sandbox = CodeSandbox(timeout=10, output_dir="test_output", workers=1, cache=False)
+
+    sandbox.execute_code("open('data.csv', 'w').write('a,b')")
+    result = sandbox.execute_code("import os\nprint(os.listdir('.'))")
+    assert result["stdout"] == "[]\n"
+
+def test_compiled_code_reused():
+    """Test that each source is compiled once, and invalid code is left to the execution"""
+    sandbox = CodeSandbox(timeout=10, output_dir="test_output", persistent=False, cache=False)
+
+    assert sandbox._compile("print('compiled')") is sandbox._compile("print('compiled')")
+    assert sandbox._compile("print(") is None
+
+def test_semantic_cache_hit(tmp_path, forbid_execution):
+    """Test that code differing only in comments, docstrings and variable names is served from the cache"""
+    sandbox = CodeSandbox(timeout=10, output_dir=str(tmp_path))
+
+    first = sandbox.execute_code("values = [1, 2, 3]\nprint(sum(values))")
+
+    forbid_execution()
+    second = sandbox.execute_code('"""Total"""\nnumbers = [1, 2, 3]   # data\nprint(sum(numbers))')
+
+    assert second["success"] and second["stdout"] == first["stdout"] == "6\n"
+    assert normalized_cache_key("x = 1\nprint(locals())") is None
+
+def test_nondeterministic_code_not_cached():
+    """Test that code using time or randomness is not considered cacheable"""
+    assert is_deterministic("import pandas as pd\nprint(pd.__name__)")
+    assert not is_deterministic("import random\nprint(random.random())")
+    assert not is_deterministic("import numpy as np\nprint(np.random.rand())")
+    assert not is_deterministic("from datetime import datetime\nprint(datetime.now())")
+    assert not is_deterministic("from numpy.random import default_rng\nprint(default_rng().random())")
+    assert not is_deterministic("from numpy import random\nprint(random.rand())")
+    assert not is_deterministic("import pandas as pd\nprint(pd.Timestamp.now())")
+    assert not is_deterministic("import os\nprint(os.urandom(4))")
+    assert not is_deterministic("import pandas as pd\nprint(pd.DataFrame({'a': [1, 2, 3]}).sample(2))")
+
+def test_kernel_helpers(tmp_path, monkeypatch):
+    """Test that the helpers are injected in the namespace, leaving the source and its line numbers untouched"""
+    monkeypatch.chdir(tmp_path)     # Restored after `execute` moves to its working directory
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setattr(kernel, "HELPERS", {"njit": lambda function: function})
+
+    result = kernel.execute("from __future__ import annotations\nprint(njit(len)('ab'))\nraise ValueError", str(tmp_path))
+    assert result["stdout"] == "2\n"
+    assert 'line 3' in result["stderr"] and "ValueError" in result["stderr"]
+
+def test_subprocess_helpers_shim(monkeypatch):
+    """Test that the one-shot path runs the code through the helpers shim unchanged, even without numba"""
+    monkeypatch.setattr(sandbox_module, "ENABLE_NUMBA", True)
+    sandbox = CodeSandbox(timeout=10, output_dir="test_output", persistent=False, cache=False)
+
+    result = sandbox.execute_code("from __future__ import annotations\nprint(__name__)\nraise ValueError")
+    assert result["stdout"] == "__main__\n"
+    assert result["stderr"].startswith("Traceback") and 'line 3' in result["stderr"] and "ValueError" in result["stderr"]
+    assert "_HELPERS_SHIM" not in result["stderr"] and "<string>" not in result["stderr"]
+
+def test_async_batch():
+    """Test that concurrent executions return their results in input order"""
+    sandbox = CodeSandbox(timeout=10, output_dir="test_output", persistent=True, cache=False)
+
+    async def run_batch():
+        return await asyncio.gather(*(sandbox.execute_code_async(f"print({i})") for i in range(4)))
+
+    results = asyncio.run(run_batch())
+    assert [result["stdout"] for result in results] == ["0\n", "1\n", "2\n", "3\n"]
+
+def test_plot_written_in_place():
+    """Test that a plot written at SANDBOX_PLOT_PATH is found in the output directory"""
+    code = "import os\nwith open(os.environ['SANDBOX_PLOT_PATH'], 'w') as f:\n    f.write('<html></html>')"
+    for persistent in (True, False):
+        sandbox = CodeSandbox(timeout=10, output_dir="test_output", persistent=persistent, cache=False, workers=1)
+        result = sandbox.execute_code(code)
+        assert result["success"], result["stderr"]
+        assert result["plot_path"].startswith("test_output")
+        with open(result["plot_path"]) as f:
+            assert f.read() == "<html></html>"
+
+def test_output_capped():
+    """Test that a flood of output is truncated without losing the final traceback"""
+    code = "for i in range(200000):\n    print('x' * 50)\nraise ValueError('after the flood')"
+    for persistent in (True, False):
+        sandbox = CodeSandbox(timeout=20, output_dir="test_output", persistent=persistent, cache=False, workers=1)
+        result = sandbox.execute_code(code)
+        assert not result["success"]
+        assert len(result["stdout"]) < 100 * 1024 and "...[truncated " in result["stdout"]
+        assert result["stderr"].rstrip().endswith("ValueError: after the flood")
+
+def test_tool_output():
+    """Test that the tool output is compact JSON with the output and error truncated"""
+    output = _format_result({"success": False, "stdout": "x" * (MAX_STDOUT + 10), "stderr": "tb" * MAX_STDERR + "ValueError", "plot_path": None})
+    assert " " not in output
+    result = json.loads(output)
+    assert result.keys() == {"ok", "out", "err", "plot"}
+    assert not result["ok"] and result["plot"] is None
+    assert len(result["out"]) == MAX_STDOUT
+    assert len(result["err"]) == MAX_STDERR and result["err"].endswith("ValueError")
+
+def run_async():
+    """Run all the example codes concurrently on the async API"""
+    sandbox = CodeSandbox(timeout=10, output_dir="test_output")
+
+    async def run_all():
+        return await asyncio.gather(*(sandbox.execute_code_async(code) for code in CODES))
+
+    for i, result in enumerate(asyncio.run(run_all()), start=1):
+        print(f"Code {i}:")
+        print(f"  Success: {result['success']}")
+        print(f"  Stdout: {result['stdout']}")
+        print(f"  Stderr: {result['stderr']}")
+        print(f"  Plot path: {result['plot_path']}")
+        print()
 
 if __name__ == "__main__":
     print("Running CodeSandbox tests...\n")
     print("=" * 60)
     
-    test_simple_execution()
-    test_plotly_generation()
-    test_timeout()
-    test_error_handling()
-    test_data_analysis()
+    if "--async" in sys.argv:
+        run_async()
+    else:
+        sandbox = CodeSandbox(timeout=10, output_dir="test_output")
+        test_simple_execution(sandbox)
+        test_plotly_generation(sandbox)
+        test_timeout()
+        test_error_handling(sandbox)
+        test_data_analysis(sandbox)
+        test_persistent_kernel()
     
     print("=" * 60)
-    print("Tests complete! Check 'test_output/' for generated plots.")
\ No newline at end of file
+    print("Tests complete! Check 'test_output/' for generated plots.")